@@ -2,7 +2,6 @@ import os
 import torch
 import numpy as np
 from torch.utils.data import Dataset
-import torch.nn.functional as F
 import networkx as nx
 
 
@@ -211,26 +210,78 @@ class HamiltonianGraphDataset(Dataset):
             layouts = generate_good_layouts(adj_matrix) # Also use good layouts for training
             node_coords = layouts[np.random.randint(len(layouts))]  # Choose one randomly
         
+        # Stored as float32 once here (networkx layouts are float64), so no cast is needed on the training path
+        node_coords = node_coords.astype(np.float32)
+        adj_matrix = adj_matrix.astype(np.float32)
+
+        # Number of real (non-zero) nodes, computed here once instead of on the device every batch
+        num_nodes = int((np.linalg.norm(node_coords, axis=1) > 0).sum())
+
         # Get the corresponding label
         label = self.labels[idx]
-        return node_coords, adj_matrix, label
-
-def custom_collate(batch, device):
-    # Extract node coordinates and adjacency matrices
-    node_coords = [torch.tensor(each[0], dtype=torch.float32).to(device) for each in batch]
-    adj_matrices = [torch.tensor(each[1], dtype=torch.float32).to(device) for each in batch]
+        return node_coords, adj_matrix, label, num_nodes
 
+def custom_collate(batch, device=None, max_nodes=None):
+    # Batches stay on the CPU by default so the DataLoader can pin them for asynchronous copies
     # Determine the maximum size among the adjacency matrices
-    max_size = max(matrix.size(0) for matrix in adj_matrices)
+    # (a fixed max_nodes keeps batch shapes static, e.g. for CUDA graph capture)
+    max_size = max(each[1].shape[0] for each in batch)
+    if max_nodes is not None:
+        max_size = max(max_size, max_nodes)
 
-    # Pad each adjacency matrix and node coordinate matrix to the maximum size
-    padded_coords = [F.pad(coord, (0, 0, 0, max_size - coord.size(0))) for coord in node_coords]
-    padded_adj_matrices = [F.pad(matrix, (0, max_size - matrix.size(0), 0, max_size - matrix.size(1))) for matrix in adj_matrices]
+    # Preallocate the contiguous, zero-padded batch tensors and copy every graph into its slice
+    # (one allocation per batch instead of a tensor, a padded copy and a stack per graph)
+    coords_batch = torch.zeros(len(batch), max_size, 2, dtype=torch.float32, device=device)
+    adj_matrices_batch = torch.zeros(len(batch), max_size, max_size, dtype=torch.float32, device=device)
+    for i, each in enumerate(batch):
+        n = each[1].shape[0]
+        coords_batch[i, :n] = torch.from_numpy(np.asarray(each[0]))
+        adj_matrices_batch[i, :n, :n] = torch.from_numpy(np.asarray(each[1]))
 
-    # Create batched tensors for both padded coordinates and adjacency matrices
-    coords_batch = torch.stack(padded_coords)
-    adj_matrices_batch = torch.stack(padded_adj_matrices)
+    labels = torch.tensor([each[2] for each in batch], dtype=torch.long, device=device)  # Labels
+    num_nodes = torch.tensor([each[3] for each in batch], dtype=torch.long, device=device)  # Node counts
 
-    labels = torch.tensor([each[2] for each in batch], dtype=torch.long).to(device)  # Labels
+    return coords_batch, adj_matrices_batch, labels, num_nodes
 
-    return coords_batch, adj_matrices_batch, labels
+
+def prefetch_to_device(data_loader, device):
+    """
+    Iterates over a DataLoader while copying the next batch to the device on a side CUDA stream,
+    so the host-to-device transfer overlaps with the compute on the current batch.
+    Build the DataLoader with pin_memory=True for the copies to be asynchronous.
+
+    Args:
+    - data_loader (DataLoader): Loader yielding tuples of tensors.
+    - device (str or torch.device): Target device.
+
+    Yields:
+    - batch (list of torch.Tensor): The batch, already on the device.
+    """
+    device = torch.device(device)
+    if device.type != 'cuda':
+        for batch in data_loader:
+            yield [x.to(device) for x in batch]
+        return
+
+    copy_stream = torch.cuda.Stream(device=device)
+    pending = None
+    for batch in data_loader:
+        # Issue the copy of this batch before handing out the previous one
+        with torch.cuda.stream(copy_stream):
+            batch = [x.to(device, non_blocking=True) for x in batch]
+            ready = torch.cuda.Event()
+            ready.record(copy_stream)
+        if pending is not None:
+            yield _wait_for_batch(*pending)
+        pending = (batch, ready)
+    if pending is not None:
+        yield _wait_for_batch(*pending)
+
+
+def _wait_for_batch(batch, ready):
+    # Make the compute stream wait for the copy and keep the memory alive for its use on that stream
+    compute_stream = torch.cuda.current_stream()
+    compute_stream.wait_event(ready)
+    for x in batch:
+        x.record_stream(compute_stream)
+    return batch
@@ -1,5 +1,8 @@
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from dataset import HamiltonianGraphDataset, custom_collate
 from model import ConditionalGraphGenerator, GraphDiscriminator, get_vit_classifier, get_resnet50_classifier
 from train import train_gan, train_combined_cgan, evaluate_model
@@ -93,8 +96,19 @@ def sample_train_val(full_dataset, sample_size, test_size=500, val_ratio=0.2, se
 
     return train_dataset, val_dataset, test_dataset, pretrain_dataset
 
+# ---- Distributed setup: launched with torchrun, each process drives one GPU ----
+local_rank = int(os.environ.get("LOCAL_RANK", -1))
+distributed = local_rank != -1
+if distributed:
+    dist.init_process_group("nccl")
+    torch.cuda.set_device(local_rank)
+
 # Set device
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+device = torch.device(f"cuda:{local_rank}" if distributed else "cuda:0" if torch.cuda.is_available() else "cpu")
+
+# Seed before sampling the splits so that every process (and every rerun) uses the same train/val/test split
+seed = 42
+np.random.seed(seed)
 
 # ---- Load Dataset ----
 # hamiltonian_dir = './small_Hamiltonian_hard'
@@ -114,11 +128,18 @@ train_dataset, val_dataset, test_dataset, pretrain_dataset = sample_train_val(fu
 # Create the DataLoader with the custom collate function
 # ---- Create DataLoaders for Train, Validation, and Test ----
 # Create DataLoader with the balanced datasets
-train_dataloader = DataLoader(train_dataset, batch_size=10, shuffle=True, collate_fn=lambda batch: custom_collate(batch, device))
-val_dataloader = DataLoader(val_dataset, batch_size=10, shuffle=False, collate_fn=lambda batch: custom_collate(batch, device))
-test_dataloader = DataLoader(test_dataset, batch_size=10, shuffle=False,collate_fn=lambda batch: custom_collate(batch, device))
+# Under DDP each process trains on its own shard of the training set
+train_sampler = DistributedSampler(train_dataset, shuffle=True) if distributed else None
+# Batches are collated on the CPU into pinned memory; the training loops copy them asynchronously
+train_dataloader = DataLoader(train_dataset, batch_size=10, shuffle=(train_sampler is None), sampler=train_sampler, collate_fn=custom_collate, pin_memory=True)
+# The evaluation loaders are pinned too, and build their batches (layout generation included) in worker processes.
+# They are evaluated every epoch, so the workers are kept alive between passes instead of being respawned
+val_dataloader = DataLoader(val_dataset, batch_size=10, shuffle=False, collate_fn=custom_collate, pin_memory=True, num_workers=4,
+                            persistent_workers=True, prefetch_factor=4)
+test_dataloader = DataLoader(test_dataset, batch_size=10, shuffle=False,collate_fn=custom_collate, pin_memory=True, num_workers=4,
+                             persistent_workers=True, prefetch_factor=4)
 # DataLoader for pretraining
-pretrain_dataloader = DataLoader(pretrain_dataset, batch_size=96, shuffle=True, collate_fn=lambda batch: custom_collate(batch, device))
+pretrain_dataloader = DataLoader(pretrain_dataset, batch_size=96, shuffle=True, collate_fn=custom_collate, pin_memory=True)
 
 # Print the dataset sizes
 print(f"Training set size: {len(train_dataset)}")
@@ -128,7 +149,6 @@ print(f"Pretrain set size: {len(pretrain_dataset)}")
 
 
 # ---- Directly set seeds for reproducibility ----
-seed = 42
 torch.manual_seed(seed)            # PyTorch seed
 torch.cuda.manual_seed(seed)       # CUDA seed (if using GPUs)
 torch.cuda.manual_seed_all(seed)   # If using multi-GPU setups
@@ -136,8 +156,11 @@ np.random.seed(seed)               # NumPy seed
 random.seed(seed)                  # Python random seed
 
 # Ensure deterministic behavior for some operations in PyTorch's backends
-torch.backends.cudnn.deterministic = True
-torch.backends.cudnn.benchmark = False
+# By default cuDNN benchmarks the convolution algorithms once per input shape and caches the fastest
+# (the classifier always sees 224x224 images); set deterministic = True for bit-reproducible runs
+deterministic = False
+torch.backends.cudnn.deterministic = deterministic
+torch.backends.cudnn.benchmark = not deterministic
 
 
 # ---- Initialize Models, Optimizers, and Criterion ----
@@ -178,6 +201,8 @@ for run in range(1, num_runs + 1):
     discriminator = GraphDiscriminator().to(device)  # Move model to device
     classifier = get_vit_classifier().to(device)  # Already moved to device in the function
     # classifier = get_resnet50_classifier().to(device)
+    # Channels-last weights for the convolutions (the ViT patch embedding, or all of ResNet-50)
+    classifier = classifier.to(memory_format=torch.channels_last)
     # Load pretrained generator and discriminator
     try:
         print("Loading pretrained generator and discriminator...")
@@ -204,6 +229,12 @@ for run in range(1, num_runs + 1):
     #     discriminator = nn.DataParallel(discriminator)
     #     classifier = nn.DataParallel(classifier)
 
+    # Use DistributedDataParallel (one process per GPU) when launched with torchrun
+    if distributed:
+        generator = DDP(generator, device_ids=[local_rank])
+        discriminator = DDP(discriminator, device_ids=[local_rank])
+        classifier = DDP(classifier, device_ids=[local_rank])
+
     optimizer_g = optim.RMSprop(generator.parameters(), lr=0.0001, weight_decay=1e-4)
     optimizer_d = optim.RMSprop(discriminator.parameters(), lr=0.0005, weight_decay=1e-4)
     optimizer_c = optim.Adam(classifier.parameters(), lr=0.00001, weight_decay=1e-4)
@@ -244,6 +275,10 @@ for run in range(1, num_runs + 1):
     )
 
     # ---- Test the model ----
-    evaluate_model(generator, classifier, test_dataloader, device)
+    # (nothing trains alongside this final run, so the classifier forward is replayed from a CUDA graph)
+    evaluate_model(generator, classifier, test_dataloader, device, use_cuda_graph=True)
 
     print(f"Completed run {run}, results saved in {output_dir}")
+
+if distributed:
+    dist.destroy_process_group()
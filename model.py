@@ -62,52 +62,26 @@ class ConditionalGraphGenerator(nn.Module):
         Returns:
         - generated_layout: Generated node coordinates (batch_size, num_nodes, output_dim)
         """
-        batch_size = input_layout.size(0)      
-        generated_layouts = []
+        batch_size, max_num_nodes, _ = input_layout.shape
 
-        # Find the maximum number of nodes in this batch
-        max_num_nodes = input_layout.size(1)
+        # The whole padded batch is processed at once; padded nodes are masked out instead of sliced away.
+        # DenseGCNConv gives a padded node only its own self-loop and zeroes its output through the mask, so the
+        # actual nodes get exactly the features of the per-graph computation
+        node_ids = torch.arange(max_num_nodes, device=input_layout.device)
+        mask = node_ids[None, :] < num_nodes.to(input_layout.device)[:, None]  # Shape: (batch_size, max_num_nodes)
 
-        for i in range(batch_size):
-            # Extract the layout and adjacency matrix for this batch item
-            num_nodes_i = num_nodes[i].item()
-            
-            # Adjust the layout to only include the actual nodes
-            layout = input_layout[i][:num_nodes_i, :]  # Shape: (num_nodes_i, 2)
-            
-            
-            # Adjust the adjacency matrix to match the number of actual nodes
-            adj = adj_matrix[i][:num_nodes_i, :num_nodes_i]  # Shape: (num_nodes_i, num_nodes_i)
-        
-            # Apply Dense GCN layers on the input layout (x, y coordinates) and dense adjacency matrix
-            # node_features = torch.relu(self.gn1(self.gcn1(layout.unsqueeze(0), adj.unsqueeze(0)))) 
-            # node_features = torch.relu(self.gn2(self.gcn2(node_features, adj.unsqueeze(0))))  # Shape: (1, num_nodes_i, hidden_dim) 
+        # Apply Dense GCN layers on the input layout (x, y coordinates) and dense adjacency matrix
+        node_features = torch.relu(self.gcn1(input_layout, adj_matrix, mask))
+        node_features = torch.relu(self.gcn2(node_features, adj_matrix, mask))  # Shape: (batch_size, max_num_nodes, hidden_dim)
 
-            node_features = torch.relu(self.gcn1(layout.unsqueeze(0), adj.unsqueeze(0)))
-            node_features = torch.relu(self.gcn2(node_features, adj.unsqueeze(0))) # Shape: (1, num_nodes_i, hidden_dim) 
+        # Encode the noise vector and broadcast it over the nodes
+        z_encoding = torch.relu(self.fc_noise(z)).unsqueeze(1).expand(-1, max_num_nodes, -1)
 
-            
+        # Concatenate node features and noise encoding
+        conditioned_input = torch.cat([node_features, z_encoding], dim=-1)  # Shape: (batch_size, max_num_nodes, hidden_dim * 2)
 
-            # Remove the batch dimension after DenseGCNConv processing
-            node_features = node_features.squeeze(0)
-        
-            # Encode the noise vector and repeat it to match num_nodes_i
-            z_encoding = torch.relu(self.fc_noise(z[i])).unsqueeze(0).repeat(num_nodes_i, 1)
-
-            # Concatenate node features and noise encoding
-            conditioned_input = torch.cat([node_features, z_encoding], dim=-1)  # Shape: (num_nodes_i, hidden_dim * 2)
-
-            # Generate new node coordinates (layout)
-            generated_layout = self.fc_out(conditioned_input)  # Shape: (num_nodes, output_dim)
-
-            # Pad the generated layout to the max number of nodes
-            padded_layout = F.pad(generated_layout, (0, 0, 0, max_num_nodes - num_nodes_i), value=0)  # Shape: (max_num_nodes, output_dim)
-
-            
-            generated_layouts.append(padded_layout)
-
-        # Stack all generated layouts into a single tensor
-        generated_layouts = torch.stack(generated_layouts)
+        # Generate new node coordinates (layout), zero at the padded nodes
+        generated_layouts = self.fc_out(conditioned_input) * mask.unsqueeze(-1)  # Shape: (batch_size, max_num_nodes, output_dim)
 
         return generated_layouts
 
@@ -196,32 +170,17 @@ class GraphDiscriminator(nn.Module):
         Returns:
         - validity: Real/fake score (batch_size, 1)
         """
-        batch_size = input_layout.size(0)
-        validity_scores = []
-        for i in range(batch_size):
-            # Extract the layout and adjacency matrix for this batch item
-            layout = input_layout[i]  # Shape: (num_nodes, 2)
-            adj = adj_matrix[i]       # Shape: (num_nodes, num_nodes)
-
-            # Apply Dense GCN layers on the input layout (x, y coordinates) and dense adjacency matrix
-            # node_features = torch.relu(self.gn1(self.gcn1(layout.unsqueeze(0), adj.unsqueeze(0))))
-            # node_features = torch.relu(self.gn2(self.gcn2(node_features, adj.unsqueeze(0))))  # Shape: (1, num_nodes, hidden_dim)
-
-            node_features = torch.relu(self.gcn1(layout.unsqueeze(0), adj.unsqueeze(0)))
-            node_features = torch.relu(self.gcn2(node_features, adj.unsqueeze(0)))  # Shape: (1, num_nodes, hidden_dim)
-
-            # Remove the batch dimension after DenseGCNConv processing
-            node_features = node_features.squeeze(0)
-
-            # Global pooling (mean over nodes)
-            pooled_features = torch.mean(node_features, dim=0)  # Shape: (hidden_dim,)
+        # The whole batch is processed at once: DenseGCNConv normalizes every graph of the batch independently,
+        # so this gives the same scores as the per-graph loop without the list of per-graph outputs
+        # Apply Dense GCN layers on the input layout (x, y coordinates) and dense adjacency matrix
+        node_features = torch.relu(self.gcn1(input_layout, adj_matrix))
+        node_features = torch.relu(self.gcn2(node_features, adj_matrix))  # Shape: (batch_size, num_nodes, hidden_dim)
 
-            # Final binary classification (real/fake)
-            validity = self.fc_out(pooled_features)  # Shape: (1,)
-            validity_scores.append(validity)
+        # Global pooling (mean over nodes)
+        pooled_features = torch.mean(node_features, dim=1)  # Shape: (batch_size, hidden_dim)
 
-        # Stack all validity scores into a single tensor
-        validity_scores = torch.stack(validity_scores).squeeze(1)  # Shape: (batch_size, 1)
+        # Final binary classification (real/fake)
+        validity_scores = self.fc_out(pooled_features).squeeze(1)  # Shape: (batch_size,)
 
         return validity_scores
 
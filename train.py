@@ -1,33 +1,104 @@
 import torch
 import time
 import csv
+import copy
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import torch.nn as nn
-from utils import wasserstein_loss, visualize_graph_layout, plot_graph_layout
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
+from dataset import prefetch_to_device
+from utils import wasserstein_loss, GraphLayoutRenderer, graph_edge_index, plot_graph_layout, is_main_process
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
 import os
 
-def calculate_f1(preds, labels):
+def confusion_counts(preds, labels):
     """
-    Function to calculate precision, recall, and F1 score.
+    Counts the true positives, false positives and false negatives of a batch of binary predictions on the device.
     Args:
         preds: Tensor of predicted labels.
         labels: Tensor of true labels.
+    Returns:
+        counts: int64 tensor [tp, fp, fn], meant to be summed over batches.
+    """
+    preds = preds == 1
+    labels = labels == 1
+    confusion = torch.stack([preds & labels, preds & ~labels, ~preds & labels])
+    return confusion.flatten(start_dim=1).sum(dim=1)
+
+def f1_from_counts(counts):
+    """
+    Function to calculate precision, recall, and F1 score from accumulated confusion counts.
+    Args:
+        counts: int64 tensor [tp, fp, fn] (see confusion_counts).
     Returns:
         precision: Precision score.
         recall: Recall score.
         f1: F1 score.
     """
-    tp = (preds * labels).sum().to(torch.float32)  # True positives
-    tn = ((1 - preds) * (1 - labels)).sum().to(torch.float32)  # True negatives
-    fp = (preds * (1 - labels)).sum().to(torch.float32)  # False positives
-    fn = ((1 - preds) * labels).sum().to(torch.float32)  # False negatives
+    # A single device-to-host transfer for the three counts
+    tp, fp, fn = counts.tolist()
 
     precision = tp / (tp + fp + 1e-8)
     recall = tp / (tp + fn + 1e-8)
     f1 = 2 * (precision * recall) / (precision + recall + 1e-8)
-
-    return precision.item(), recall.item(), f1.item()
+    return precision, recall, f1
+
+def _save_layout_png(layout, adj_matrix, path):
+    # Runs on the I/O thread: matplotlib rendering, PIL encoding and the disk write
+    img = plot_graph_layout(layout, adj_matrix=adj_matrix, return_tensor=False)
+    img.save(path)
+
+def _write_csv_row(log_file, writer, row):
+    # Runs on the I/O thread, rows stay in submission order since the executor has a single worker
+    writer.writerow(row)
+    log_file.flush()
+
+def _unwrap(module):
+    # The plain module behind a DDP wrapper
+    return module.module if isinstance(module, DDP) else module
+
+def _snapshot(module, compile=False):
+    # A copy of an uncompiled module for the background evaluation, compiled on its own when requested
+    # (a deepcopy of a compiled module would keep a compiled forward bound to the original)
+    snapshot = copy.deepcopy(module)
+    if compile:
+        snapshot.compile()
+    return snapshot
+
+def _cpu_copy(state):
+    # A host copy of a (nested) state dict, so a pending checkpoint does not hold GPU memory
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: _cpu_copy(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_cpu_copy(value) for value in state)
+    return copy.deepcopy(state)
+
+def _evaluate_snapshot(generator, classifier, loaders, device, stream):
+    # Runs on the evaluation thread, on its own CUDA stream so it overlaps with the next epoch's training
+    if stream is None:
+        return [evaluate_model(generator, classifier, loader, device) for loader in loaders]
+    torch.cuda.set_device(stream.device)
+    with torch.cuda.stream(stream):
+        return [evaluate_model(generator, classifier, loader, device) for loader in loaders]
+
+def _no_sync(module):
+    # Skips DDP's gradient bookkeeping for forward passes whose parameters receive no gradient
+    return module.no_sync() if isinstance(module, DDP) else contextlib.nullcontext()
+
+# The elementwise parts of the gradient penalty are compiled so Inductor fuses them into single kernels
+@torch.compile(fullgraph=True)
+def _interpolate(alpha, real, fake):
+    return alpha * real + (1 - alpha) * fake
+
+@torch.compile(fullgraph=True)
+def _gp_norm(gradients, lambda_gp):
+    gradient_norm = gradients.view(gradients.size(0), -1).norm(2, dim=1)
+    return lambda_gp * ((gradient_norm - 1) ** 2).mean()
 
 def compute_gradient_penalty(discriminator, real_samples, fake_samples, real_adj, fake_adj, device, lambda_gp=3):
     """
@@ -47,46 +118,129 @@ def compute_gradient_penalty(discriminator, real_samples, fake_samples, real_adj
     """
     batch_size = real_samples.size(0)
     num_nodes = real_adj.size(1)
+    # Both training loops pass the same adjacency for real and fake samples, the interpolation is then the identity
+    same_adj = real_adj is fake_adj
 
-    # Random weight term for interpolation between real and fake samples
-    alpha_samples = torch.rand(batch_size, 1, 1).to(device)
-    alpha_samples = alpha_samples.expand_as(real_samples)
-
-    alpha_adj = torch.rand(batch_size, num_nodes, num_nodes).to(device)  # Expand alpha for adjacency matrices
+    # The penalty is always computed in FP32: double backward through an FP16 graph is numerically brittle
+    with torch.autocast(device_type=torch.device(device).type, enabled=False):
+        real_samples, fake_samples = real_samples.float(), fake_samples.float()
+        real_adj, fake_adj = real_adj.float(), fake_adj.float()
 
-    # Interpolates between real and fake samples for both node coordinates and adjacency matrices
-    interpolated_samples = (alpha_samples * real_samples + (1 - alpha_samples) * fake_samples).requires_grad_(True)
-    interpolated_adj = (alpha_adj * real_adj + (1 - alpha_adj) * fake_adj).requires_grad_(True)
+        # Random weight term for interpolation between real and fake samples (broadcast over nodes)
+        alpha_samples = torch.rand(batch_size, 1, 1, device=device)
 
-    # Discriminator's output on the interpolated samples
-    d_interpolates = discriminator(interpolated_samples, interpolated_adj)
-
-    # Compute gradients of the discriminator's output with respect to the interpolated samples
-    gradients = torch.autograd.grad(
-        outputs=d_interpolates,
-        inputs=[interpolated_samples, interpolated_adj],
-        grad_outputs=torch.ones(d_interpolates.size()).to(device),
-        create_graph=True,
-        retain_graph=True,
-        only_inputs=True,
-        #allow_unused=True  # This prevents the error when some tensors are not used in the graph
-    )[0]
+        # Interpolates between real and fake samples for both node coordinates and adjacency matrices
+        interpolated_samples = _interpolate(alpha_samples, real_samples, fake_samples)
+        if same_adj:
+            interpolated_adj = real_adj
+        else:
+            alpha_adj = torch.rand(batch_size, num_nodes, num_nodes, device=device)  # Expand alpha for adjacency matrices
+            interpolated_adj = _interpolate(alpha_adj, real_adj, fake_adj)
+        # Only the coordinate gradient enters the penalty, so the adjacency stays a constant and the
+        # double-backward graph does not carry a (B, N, N) gradient branch that is discarded anyway
+        interpolated_samples.requires_grad_(True)
+
+        # Discriminator's output on the interpolated samples
+        d_interpolates = discriminator(interpolated_samples, interpolated_adj)
+
+        # Compute gradients of the discriminator's output with respect to the interpolated samples
+        # (create_graph already retains the graph for the outer backward)
+        gradients = torch.autograd.grad(
+            outputs=d_interpolates,
+            inputs=interpolated_samples,
+            grad_outputs=torch.ones_like(d_interpolates),
+            create_graph=True,
+            only_inputs=True,
+            #allow_unused=True  # This prevents the error when some tensors are not used in the graph
+        )[0]
+
+
+        # Compute the gradient penalty from the gradient norm: (||grad||_2 - 1)^2
+        gradient_penalty = _gp_norm(gradients, lambda_gp)
 
+    return gradient_penalty
 
-    # Compute the gradient norm ||grad||_2
-    gradients = gradients.view(batch_size, -1)
-    gradient_norm = gradients.norm(2, dim=1)
+def capture_discriminator_step(discriminator, optimizer_d, node_coords, fake_coords, adj_matrices, device, lambda_gp, warmup_iters=3):
+    """
+    Captures one full discriminator update (forward, WGAN-GP loss, backward and optimizer step) into a CUDA graph.
 
-    # Compute the gradient penalty: (||grad||_2 - 1)^2
-    gradient_penalty = lambda_gp * ((gradient_norm - 1) ** 2).mean()
+    Args:
+        discriminator (nn.Module): The discriminator network.
+        optimizer_d (torch.optim.Optimizer): Discriminator optimizer, constructed with capturable=True.
+        node_coords (torch.Tensor): Example real layouts, fixes the static batch shape.
+        fake_coords (torch.Tensor): Example generated layouts with the same shape as node_coords.
+        adj_matrices (torch.Tensor): Example adjacency matrices.
+        device (str): The CUDA device.
+        lambda_gp (float): The gradient penalty weight.
+        warmup_iters (int): Number of eager iterations run on a side stream before capture.
 
-    return gradient_penalty
+    Returns:
+        step (callable): step(node_coords, fake_coords, adj_matrices) copies a batch into the static buffers,
+                         replays the graph and returns (d_loss, real_validity, fake_validity).
+    """
+    if not all(group.get('capturable', False) for group in optimizer_d.param_groups):
+        raise ValueError("optimizer_d must be constructed with capturable=True to capture the discriminator step.")
+
+    # Static input buffers, the graph always reads from these addresses
+    static_node_coords = node_coords.detach().clone()
+    static_fake_coords = fake_coords.detach().float().clone()
+    static_adj = adj_matrices.detach().clone()
+
+    def d_step():
+        real_validity = discriminator(static_node_coords, static_adj)
+        fake_validity = discriminator(static_fake_coords, static_adj)
+        gp = compute_gradient_penalty(discriminator, static_node_coords, static_fake_coords, static_adj, static_adj, device, lambda_gp)
+        d_loss = wasserstein_loss(real_validity, fake_validity) + gp
+        d_loss.backward()
+        optimizer_d.step()
+        return d_loss, real_validity, fake_validity
+
+    # Snapshot the weights and optimizer state so the warmup updates can be rolled back
+    saved_weights = copy.deepcopy(discriminator.state_dict())
+    saved_state = {param: {key: value.clone() for key, value in state.items() if torch.is_tensor(value)}
+                   for param, state in optimizer_d.state.items()}
+
+    # Warmup on a side stream initializes the optimizer state and autograd buffers before capture
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for _ in range(warmup_iters):
+            optimizer_d.zero_grad(set_to_none=True)
+            d_step()
+    torch.cuda.current_stream().wait_stream(side_stream)
+
+    # Roll back in place (the graph captures tensor addresses); freshly created state starts from zero
+    discriminator.load_state_dict(saved_weights)
+    with torch.no_grad():
+        for param, state in optimizer_d.state.items():
+            for key, value in state.items():
+                if not torch.is_tensor(value):
+                    continue
+                if param in saved_state:
+                    value.copy_(saved_state[param][key])
+                else:
+                    value.zero_()
+
+    # Gradients are allocated inside the graph's private memory pool
+    optimizer_d.zero_grad(set_to_none=True)
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_d_loss, static_real_validity, static_fake_validity = d_step()
+
+    def step(node_coords, fake_coords, adj_matrices):
+        static_node_coords.copy_(node_coords, non_blocking=True)
+        static_fake_coords.copy_(fake_coords, non_blocking=True)
+        static_adj.copy_(adj_matrices, non_blocking=True)
+        graph.replay()
+        return static_d_loss, static_real_validity, static_fake_validity
+
+    return step
 
 # ---- Pretrain Generator ----
 # ---- Pretrain Both Generator and Discriminator Together ----
 
 def train_gan(generator, discriminator, data_loader, optimizer_g, optimizer_d, device, epochs, output_dir, 
-              lambda_gp=1, lambda_rec=100, patience=20):
+              lambda_gp=1, lambda_rec=100, patience=20, use_amp=True, use_cuda_graph=False):
     os.makedirs(output_dir, exist_ok=True)
     log_path = os.path.join(output_dir, "metrics_gan.csv")
     save_path_g = os.path.join(output_dir, "best_generator_pretrained.pth")
@@ -96,7 +250,20 @@ def train_gan(generator, discriminator, data_loader, optimizer_g, optimizer_d, d
     """
     Train both the generator and discriminator together.
     """
+    # Image dumps and CSV appends run on a background thread so disk I/O does not block the training loop
+    io_executor = ThreadPoolExecutor(max_workers=1)
     #loss_fn = nn.MSELoss()
+    # Mixed precision: FP16 autocast for the forward passes, one GradScaler per optimizer (CUDA only)
+    use_amp = use_amp and torch.device(device).type == 'cuda'
+    scaler_g = torch.amp.GradScaler('cuda', enabled=use_amp)
+    scaler_d = torch.amp.GradScaler('cuda', enabled=use_amp)
+
+    # Optional CUDA graph for the discriminator update. It needs fixed batch shapes (pad the loader to a
+    # fixed max_nodes); batches with a different shape fall back to the eager update.
+    use_cuda_graph = use_cuda_graph and torch.device(device).type == 'cuda'
+    d_graph_step = None
+    d_graph_shape = None
+
     best_g_loss = float('inf')
     best_d_loss = float('inf')
     best_d_accuracy = 0
@@ -107,18 +274,25 @@ def train_gan(generator, discriminator, data_loader, optimizer_g, optimizer_d, d
     stop_training_g = False # Flag for stopping generator parameter updates
     stop_training_d = False # Flag for stopping discriminator parameter updates
 
-    # Dictionary to store performance metrics
+    # Dictionary to store performance metrics, one preallocated slot per epoch (NaN for epochs that did not run)
     metrics = {
-        "epoch": [],
-        "generator_loss": [],
-        "reconstruction_loss":[],
-        "discriminator_loss": [],
-        "discriminator_accuracy":[]
+        "epoch": torch.arange(1, epochs + 1),
+        "generator_loss": torch.full((epochs,), float('nan')),
+        "reconstruction_loss": torch.full((epochs,), float('nan')),
+        "discriminator_loss": torch.full((epochs,), float('nan')),
+        "discriminator_accuracy": torch.full((epochs,), float('nan'))
     }
 
-    with open(log_path, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['epoch', 'generator_loss', 'reconstruction_loss','discriminator_loss','discriminator_accuracy'])
+    # The CSV file stays open for the whole run, every row is flushed as it is written
+    log_file = open(log_path, 'w', newline='')
+    log_writer = csv.writer(log_file)
+    io_executor.submit(_write_csv_row, log_file, log_writer,
+                       ['epoch', 'generator_loss', 'reconstruction_loss','discriminator_loss','discriminator_accuracy'])
+
+    n_batches = len(data_loader)
+
+    # Noise buffer allocated once on the device and refilled in place every batch
+    z_buffer = torch.empty(data_loader.batch_size, 128, device=device)
 
     for epoch in range(epochs):
         if stop_training_g and stop_training_d:
@@ -128,121 +302,138 @@ def train_gan(generator, discriminator, data_loader, optimizer_g, optimizer_d, d
         epoch_start = time.time()  # Start timing the epoch
         generator.train()
         discriminator.train()
-        total_g_loss = 0
-        total_d_loss = 0
-        total_reconstruction_loss = 0
+        # Losses and accuracy counters stay on the device, they are synced once at the end of the epoch
+        total_g_loss = torch.zeros((), device=device)
+        total_d_loss = torch.zeros((), device=device)
+        total_reconstruction_loss = torch.zeros((), device=device)
 
         # Initialize counters for discriminator accuracy
-        correct_real = 0
-        correct_fake = 0
+        correct_real = torch.zeros((), device=device)
+        correct_fake = torch.zeros((), device=device)
         total_real = 0
         total_fake = 0
 
-        for batch_idx, (node_coords, adj_matrices,  _) in enumerate(data_loader):
+        # Batches arrive on the device, the copy of the next one overlaps with this batch's compute
+        # (num_nodes, the number of non-zero nodes of each graph, is precomputed by the dataset)
+        for batch_idx, (node_coords, adj_matrices,  _, num_nodes) in enumerate(prefetch_to_device(data_loader, device)):
             batch_start = time.time()  # Start timing the batch
-            adj_matrices = adj_matrices.to(device)
-            node_coords = node_coords.to(device)
 
             # Generate random noise
-            z = torch.randn(node_coords.shape[0], 128).to(device)
-            non_zero_nodes_mask = torch.norm(node_coords, dim=2) > 0  # Shape: (96, 46)
-
-            # Count the number of non-zero nodes (num_nodes) for each graph in the batch
-            num_nodes = non_zero_nodes_mask.sum(dim=1)  # Shape: (96,) - number of nodes for each graph in the batch
-
-            #generated_coords = generator(z, node_coords, num_nodes)
-            generated_coords = generator(z, node_coords, adj_matrices, num_nodes)
-            #real_validity = discriminator(node_coords)
-            real_validity = discriminator(node_coords, adj_matrices)
-            #fake_validity = discriminator(generated_coords.detach())
-            fake_validity = discriminator(generated_coords.detach(),adj_matrices)  # Detach to avoid updating generator
+            z = z_buffer[:node_coords.shape[0]].normal_()
+
+            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=use_amp):
+                #generated_coords = generator(z, node_coords, num_nodes)
+                generated_coords = generator(z, node_coords, adj_matrices, num_nodes)
+
+            # Capture the discriminator update on the first full batch
+            if use_cuda_graph and not stop_training_d and d_graph_step is None:
+                d_graph_step = capture_discriminator_step(discriminator, optimizer_d, node_coords, generated_coords,
+                                                          adj_matrices, device, lambda_gp)
+                d_graph_shape = node_coords.shape
+            replay_d_step = d_graph_step is not None and not stop_training_d and node_coords.shape == d_graph_shape
+
+            if replay_d_step:
+                # Replay the captured discriminator update (runs in FP32, outside the GradScaler)
+                d_loss, real_validity, fake_validity = d_graph_step(node_coords, generated_coords.detach(), adj_matrices)
+                total_d_loss += d_loss.detach()
+            else:
+                with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=use_amp):
+                    #real_validity = discriminator(node_coords)
+                    real_validity = discriminator(node_coords, adj_matrices)
+                    # A single critic forward on the generated layouts is shared by the generator and discriminator updates
+                    fake_validity = discriminator(generated_coords, adj_matrices)
 
             # print(f"Real Validity - Mean: {real_validity.mean().item():.4f}, Std: {real_validity.std().item():.4f}")
             # print(f"Fake Validity - Mean: {fake_validity.mean().item():.4f}, Std: {fake_validity.std().item():.4f}")
 
+            # Train Generator if not stopped (gradients first, the step is applied after the discriminator's backward)
+            if not stop_training_g:
+            
+                with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=use_amp):
+                    # The replayed graph only returns static outputs, so the generator needs its own critic forward
+                    fake_validity_g = discriminator(generated_coords, adj_matrices) if replay_d_step else fake_validity
+                    generate_loss = -torch.mean(fake_validity_g)  # Negative critic score on fake samples (WGAN)
+
+                    # Reconstruction loss between generated and real layouts
+                    reconstruction_loss = F.mse_loss(generated_coords, node_coords)
+
+                    # Total generator loss
+                    g_loss = generate_loss + lambda_rec * reconstruction_loss
+                optimizer_g.zero_grad(set_to_none=True)
+                # Only the generator's gradients; keep the graph for the discriminator's backward through fake_validity
+                scaler_g.scale(g_loss).backward(inputs=list(generator.parameters()), retain_graph=True)
+
             # Train Discriminator if not stopped
-            if not stop_training_d:
+            if not stop_training_d and not replay_d_step:
                 # Discriminator loss (Wasserstein Loss)
                 discriminator_loss = wasserstein_loss(real_validity, fake_validity)
                 # Compute gradient penalty
-                gp = compute_gradient_penalty(discriminator, node_coords, generated_coords, adj_matrices, adj_matrices, device, lambda_gp)
+                # (the penalty only needs the generated values, not the generator's graph)
+                gp = compute_gradient_penalty(discriminator, node_coords, generated_coords.detach(), adj_matrices, adj_matrices, device, lambda_gp)
                 # Add gradient penalty to discriminator loss
                 d_loss = discriminator_loss + gp
 
-                optimizer_d.zero_grad()
-                d_loss.backward(retain_graph=True)  # Only retain the graph for the discriminator's backward pass
+                optimizer_d.zero_grad(set_to_none=True)
+                # Only the discriminator's gradients, fake_validity is not detached from the generator
+                scaler_d.scale(d_loss).backward(inputs=list(discriminator.parameters()))
 
                 # Apply gradient clipping to discriminator
                 # torch.nn.utils.clip_grad_norm_(discriminator.parameters(), max_norm=5.0)
-                optimizer_d.step()
-                total_d_loss += d_loss.item()
+                scaler_d.step(optimizer_d)
+                scaler_d.update()
+                total_d_loss += d_loss.detach()
+
+            if not stop_training_g:
+                # Apply gradient clipping to generator
+                # torch.nn.utils.clip_grad_norm_(generator.parameters(), max_norm=5.0)
+                scaler_g.step(optimizer_g)
+                scaler_g.update()
+                total_g_loss += g_loss.detach()
+                total_reconstruction_loss += reconstruction_loss.detach()
 
             # ---- Update Discriminator Accuracy Counters ----
+            real_validity, fake_validity = real_validity.detach(), fake_validity.detach()
             # Concatenate real and fake scores
             all_validity = torch.cat([real_validity, fake_validity], dim=0)
             # Compute dynamic threshold (using median)
-            threshold = all_validity.median().item()
+            threshold = all_validity.median()
             # Make predictions based on threshold
             real_predictions = (real_validity > threshold).float()
             fake_predictions = (fake_validity <= threshold).float()
 
             # Update counters
-            correct_real += real_predictions.sum().item()
-            correct_fake += fake_predictions.sum().item()
+            correct_real += real_predictions.sum()
+            correct_fake += fake_predictions.sum()
             total_real += real_predictions.numel()
             total_fake += fake_predictions.numel()
-
-             # Train Generator if not stopped
-            if not stop_training_g:
-            
-                #fake_validity = discriminator(generated_coords)
-                fake_validity = discriminator(generated_coords,adj_matrices)
-                generate_loss = -torch.mean(fake_validity)  # Negative critic score on fake samples (WGAN)
-
-                # Reconstruction loss between generated and real layouts
-                reconstruction_loss = F.mse_loss(generated_coords, node_coords)
-
-                # Total generator loss
-                g_loss = generate_loss + lambda_rec * reconstruction_loss
-                optimizer_g.zero_grad()
-                g_loss.backward()
-
-                # Apply gradient clipping to generator
-                # torch.nn.utils.clip_grad_norm_(generator.parameters(), max_norm=5.0)
-                optimizer_g.step()
-                total_g_loss += g_loss.item()
-                total_reconstruction_loss += reconstruction_loss.item()
         
 
             if batch_idx % 30 == 0:  # Visualize and save every 10 batches
-                for i, layout in enumerate(generated_coords[:3]):  # Visualize the first 3 generated layouts
-                    # Generate the image using your visualize_graph_layout function
-                    img = plot_graph_layout(
-                        layout[:num_nodes[i].item()].detach().cpu().numpy(),
-                        adj_matrix=adj_matrices[i].detach().cpu().numpy(),
-                        return_tensor=False  # Set return_tensor to False to get the PIL image instead of a tensor
-                    )
-
+                # One device-to-host copy for the first 3 generated layouts, the rendering and saving run on the I/O thread
+                layouts_cpu = generated_coords[:3].detach().float().cpu().numpy()
+                adj_cpu = adj_matrices[:3].detach().cpu().numpy()
+                for i, n in enumerate(num_nodes[:3].tolist()):  # Visualize the first 3 generated layouts
                     # Construct the filename using the epoch, batch index, and image index
                     image_filename = f"epoch_{epoch}_batch_{batch_idx}_image_{i}.png"
                     
-                    # Save the image in the specified directory
-                    img.save(os.path.join(image_output_dir, image_filename))
+                    # Generate the image using plot_graph_layout and save it in the specified directory
+                    io_executor.submit(_save_layout_png, layouts_cpu[i, :n], adj_cpu[i],
+                                       os.path.join(image_output_dir, image_filename))
 
                     # # Optionally, you can still display the image (remove this if not needed)
                     # plt.imshow(img)
                     # plt.show()  # Show the image
 
             # Print batch processing time
-            print(f"Batch {batch_idx + 1}/{len(data_loader)} processed in {time.time() - batch_start:.2f} seconds")
+            print(f"Batch {batch_idx + 1}/{n_batches} processed in {time.time() - batch_start:.2f} seconds")
 
-        avg_g_loss = total_g_loss / len(data_loader)
-        avg_d_loss = total_d_loss / len(data_loader)
-        avg_reconstruction_loss = total_reconstruction_loss / len(data_loader)
+        avg_g_loss = total_g_loss.item() / n_batches
+        avg_d_loss = total_d_loss.item() / n_batches
+        avg_reconstruction_loss = total_reconstruction_loss.item() / n_batches
 
          # Calculate discriminator accuracy
         if total_real + total_fake > 0:
-            total_correct = correct_real + correct_fake
+            total_correct = (correct_real + correct_fake).item()
             total_samples = total_real + total_fake
             discriminator_accuracy = (total_correct / total_samples) * 100
         else:
@@ -285,50 +476,75 @@ def train_gan(generator, discriminator, data_loader, optimizer_g, optimizer_d, d
         
 
         # Log metrics for this epoch
-        metrics["epoch"].append(epoch + 1)
-        metrics["generator_loss"].append(avg_g_loss)
-        metrics["reconstruction_loss"].append(avg_reconstruction_loss)
-        metrics["discriminator_loss"].append(avg_d_loss)
-        metrics["discriminator_accuracy"].append(discriminator_accuracy)
+        metrics["generator_loss"][epoch] = avg_g_loss
+        metrics["reconstruction_loss"][epoch] = avg_reconstruction_loss
+        metrics["discriminator_loss"][epoch] = avg_d_loss
+        metrics["discriminator_accuracy"][epoch] = discriminator_accuracy
         
         # Append metrics to the CSV file
-        with open(log_path, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([epoch + 1, avg_g_loss,avg_reconstruction_loss, avg_d_loss, discriminator_accuracy])
+        io_executor.submit(_write_csv_row, log_file, log_writer, [epoch + 1, avg_g_loss,avg_reconstruction_loss, avg_d_loss, discriminator_accuracy])
 
+    # Wait for the pending image dumps and CSV rows
+    io_executor.shutdown(wait=True)
+    log_file.close()
 
 
 def train_combined_cgan(generator, discriminator, classifier, train_loader, val_loader, test_loader, 
                         optimizer_g, optimizer_d, optimizer_c, scheduler_g, scheduler_d, scheduler_c, criterion, 
-                        device, epochs=100, patience=10, output_dir=".", lambda_gp=5, alpha=30, num_z_samples=10):
+                        device, epochs=100, patience=10, output_dir=".", lambda_gp=5, alpha=30, num_z_samples=10, use_amp=True,
+                        differentiable_render=False, use_compile=True):
     os.makedirs(output_dir, exist_ok=True)
     log_path = os.path.join(output_dir, "metrics_combined_train.csv")
     save_path = os.path.join(output_dir, "best_model.pth")
     image_output_dir = os.path.join(output_dir, "generated_images")
     os.makedirs(image_output_dir, exist_ok=True)
+    # Under DDP every rank trains on its shard of the data, but only rank 0 writes logs, checkpoints and images
+    is_main = is_main_process()
+    # Image dumps and CSV appends run on a background thread so disk I/O does not block the training loop
+    io_executor = ThreadPoolExecutor(max_workers=1)
     
+    # Mixed precision: FP16 autocast for the forward passes, one GradScaler per optimizer (CUDA only)
+    use_amp = use_amp and torch.device(device).type == 'cuda'
+    scaler_g = torch.amp.GradScaler('cuda', enabled=use_amp)
+    scaler_d = torch.amp.GradScaler('cuda', enabled=use_amp)
+    scaler_c = torch.amp.GradScaler('cuda', enabled=use_amp)
+
+    # Snapshots of the generator and classifier for the background evaluation (see below). Both are snapshotted
+    # before they are compiled, then the training models and their snapshots are each compiled in place
+    # (state_dict keys stay unprefixed). The default mode is used, not 'reduce-overhead': its CUDA graphs do not
+    # mix with the background evaluation thread. The padded node count varies between batches, so the
+    # generator is recompiled once with a dynamic node dimension
+    eval_generator = _snapshot(_unwrap(generator), compile=use_compile)
+    eval_classifier = _snapshot(_unwrap(classifier), compile=use_compile)
+    if use_compile:
+        _unwrap(generator).compile()
+        _unwrap(classifier).compile()
+
     best_accuracy = 0  # Initialize best accuracy
     epochs_without_improvement = 0  # Counter for early stopping
 
-    # Dictionary to store performance metrics
+    # Dictionary to store performance metrics, one preallocated slot per epoch plus the initial model at index 0
+    # (NaN for values that do not exist or epochs that did not run)
     metrics = {
-        "epoch": [],
-        "generator_loss": [],
-        "discriminator_loss": [],
-        "classifier_loss": [],
-        "train_accuracy": [],
-        "train_f1": [],
-        "val_accuracy": [],
-        "val_f1": [],
-        "test_accuracy": [],
-        "test_f1": []
+        "epoch": torch.arange(epochs + 1),
+        "generator_loss": torch.full((epochs + 1,), float('nan')),
+        "discriminator_loss": torch.full((epochs + 1,), float('nan')),
+        "classifier_loss": torch.full((epochs + 1,), float('nan')),
+        "train_accuracy": torch.full((epochs + 1,), float('nan')),
+        "train_f1": torch.full((epochs + 1,), float('nan')),
+        "val_accuracy": torch.full((epochs + 1,), float('nan')),
+        "val_f1": torch.full((epochs + 1,), float('nan')),
+        "test_accuracy": torch.full((epochs + 1,), float('nan')),
+        "test_f1": torch.full((epochs + 1,), float('nan'))
     }
 
-    # Create a CSV file and write the headers
-    with open(log_path, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(["epoch", "generator_loss", "discriminator_loss", "classifier_loss", "train_accuracy", 
-                         "train_f1", "val_accuracy", "val_f1", "test_accuracy", "test_f1"])
+    # Create a CSV file and write the headers (the file stays open for the whole run, every row is flushed)
+    if is_main:
+        log_file = open(log_path, 'w', newline='')
+        log_writer = csv.writer(log_file)
+        io_executor.submit(_write_csv_row, log_file, log_writer,
+                           ["epoch", "generator_loss", "discriminator_loss", "classifier_loss", "train_accuracy", 
+                            "train_f1", "val_accuracy", "val_f1", "test_accuracy", "test_f1"])
         
     
     # ---- Evaluate the performance of the untrained (initial) model ----
@@ -338,53 +554,116 @@ def train_combined_cgan(generator, discriminator, classifier, train_loader, val_
     test_accuracy, test_f1 = evaluate_model(generator, classifier, test_loader, device)
 
     # Log the initial metrics as "epoch 0"
-    metrics["epoch"].append(0)
-    metrics["generator_loss"].append(None)  # No generator loss yet
-    metrics["discriminator_loss"].append(None)  # No discriminator loss yet
-    metrics["classifier_loss"].append(None)  # No classifier loss yet
-    metrics["train_accuracy"].append(train_accuracy)
-    metrics["train_f1"].append(train_f1)
-    metrics["val_accuracy"].append(val_accuracy)
-    metrics["val_f1"].append(val_f1)
-    metrics["test_accuracy"].append(test_accuracy)
-    metrics["test_f1"].append(test_f1)
+    # (no generator, discriminator or classifier loss yet, those stay NaN)
+    metrics["train_accuracy"][0] = train_accuracy
+    metrics["train_f1"][0] = train_f1
+    metrics["val_accuracy"][0] = val_accuracy
+    metrics["val_f1"][0] = val_f1
+    metrics["test_accuracy"][0] = test_accuracy
+    metrics["test_f1"][0] = test_f1
 
     # Append initial metrics to the CSV file
-    with open(log_path, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([0, None, None, None, train_accuracy, train_f1, val_accuracy, val_f1, test_accuracy, test_f1])
+    if is_main:
+        io_executor.submit(_write_csv_row, log_file, log_writer,
+                           [0, None, None, None, train_accuracy, train_f1, val_accuracy, val_f1, test_accuracy, test_f1])
 
     print(f"Initial Model - Train Accuracy: {train_accuracy:.2f}%, Validation Accuracy: {val_accuracy:.2f}%, Test Accuracy: {test_accuracy:.2f}%")
     print(f"Initial Model - Train F1: {train_f1:.4f}, Validation F1: {val_f1:.4f}, Test F1: {test_f1:.4f}")
     
+    # Noise buffer for the whole z-sample super-batch, allocated once on the device and refilled in place every batch
+    z_buffer = torch.empty(train_loader.batch_size * num_z_samples, 128, device=device)
+    n_batches = len(train_loader)
+    # Layout-to-image renderer for the classifier input, its kernels are built once and reused every batch
+    renderer = GraphLayoutRenderer(size=(224, 224))
+
+    # The epoch-end validation and test runs are evaluated in a background thread on snapshots of the generator and
+    # classifier (on a side stream on CUDA), overlapping with the next epoch's training. Their logging, checkpointing
+    # and early stopping are resolved after that next epoch, or after the loop for the last one.
+    eval_executor = ThreadPoolExecutor(max_workers=1)
+    eval_stream = torch.cuda.Stream(device=device) if torch.device(device).type == 'cuda' else None
+    pending_eval = None  # (epoch, future, training stats, checkpoint)
+
+    def finish_evaluation(pending):
+        """
+        Logs a finished background evaluation and runs the checkpointing and early-stopping bookkeeping for its epoch.
+
+        Returns:
+            stop (bool): Whether early stopping was triggered.
+        """
+        nonlocal best_accuracy, epochs_without_improvement
+        epoch, future, (avg_g_loss, avg_d_loss, avg_c_loss, train_accuracy, avg_f1_train), checkpoint = pending
+        (val_accuracy, val_f1), (test_accuracy, test_f1) = future.result()
+
+        print(f"Epoch {epoch + 1} evaluation:")
+        print(f"Validation Accuracy: {val_accuracy:.2f}%, Validation F1: {val_f1:.4f}")
+        print(f"Test Accuracy: {test_accuracy:.2f}%, Test F1: {test_f1:.4f}")
+
+        # Log metrics for this epoch
+        metrics["generator_loss"][epoch + 1] = avg_g_loss
+        metrics["discriminator_loss"][epoch + 1] = avg_d_loss
+        metrics["classifier_loss"][epoch + 1] = avg_c_loss
+        metrics["train_accuracy"][epoch + 1] = train_accuracy
+        metrics["train_f1"][epoch + 1] = avg_f1_train
+        metrics["val_accuracy"][epoch + 1] = val_accuracy
+        metrics["val_f1"][epoch + 1] = val_f1
+        metrics["test_accuracy"][epoch + 1] = test_accuracy
+        metrics["test_f1"][epoch + 1] = test_f1
+
+        # Append metrics to CSV file
+        if is_main:
+            io_executor.submit(_write_csv_row, log_file, log_writer,
+                               [epoch + 1, avg_g_loss, avg_d_loss, avg_c_loss, train_accuracy, avg_f1_train, val_accuracy, val_f1, test_accuracy, test_f1])
+
+        # All ranks follow rank 0's validation accuracy so checkpointing and early stopping stay in lockstep
+        if dist.is_available() and dist.is_initialized():
+            val_accuracy_tensor = torch.tensor([val_accuracy], device=device)
+            dist.broadcast(val_accuracy_tensor, src=0)
+            val_accuracy = val_accuracy_tensor.item()
+
+        # Check for improvement in accuracy
+        if val_accuracy > best_accuracy :
+            best_accuracy = val_accuracy
+            epochs_without_improvement = 0  # Reset the counter if accuracy improves
+
+            # Save the best model (the state snapshotted at the end of the evaluated epoch)
+            if is_main:
+                checkpoint['val_accuracy'] = val_accuracy
+                checkpoint['test_accuracy'] = test_accuracy
+                torch.save(checkpoint, save_path)
+            print(f"Best model saved with validation accuracy: {val_accuracy:.2f}%")
+        else:
+            epochs_without_improvement += 1
+            print(f"Epochs without improvement: {epochs_without_improvement}")
+
+        # Early stopping condition
+        if epochs_without_improvement >= patience:
+            print(f"Early stopping triggered. No improvement for {patience} consecutive epochs.")
+            return True
+        return False
 
     for epoch in range(epochs):
         epoch_start = time.time()  # Start timing the epoch
         generator.train()
         discriminator.train()
         classifier.train()
+        if isinstance(train_loader.sampler, DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)  # Reshuffle the shards every epoch
 
         total_g_loss = 0
         total_d_loss = 0
         total_c_loss = 0
-        correct_train = 0
+        correct_train = torch.zeros((), dtype=torch.long, device=device)
         total_train = 0  # For calculating training accuracy
-        total_f1_train = 0  # For calculating average F1 score for training
+        f1_counts_train = torch.zeros(3, dtype=torch.long, device=device)  # tp/fp/fn for the training F1 score
 
         # Training phase
-        for batch_idx, (graph_layouts, adj_matrices, labels) in enumerate(train_loader):
+        # Batches arrive on the device, the copy of the next one overlaps with this batch's compute
+        # (num_nodes, the number of non-zero nodes of each graph, is precomputed by the dataset)
+        for batch_idx, (graph_layouts, adj_matrices, labels, num_nodes) in enumerate(prefetch_to_device(train_loader, device)):
             batch_start = time.time()  # Start timing the batch
-            graph_layouts = graph_layouts.float().to(device)  # Move data to device
-            adj_matrices = adj_matrices.float().to(device)  # Adjacency matrices
-            labels = labels.to(device)  # Move labels to device
 
              # Get the number of nodes from the adjacency matrix (which should match graph_layouts)
             #num_nodes = adj_matrices.size(1)
-            # Calculate the mask of non-zero coordinates (true if norm > 0)
-            non_zero_nodes_mask = torch.norm(graph_layouts, dim=2) > 0  # Shape: (96, 46)
-
-            # Count the number of non-zero nodes (num_nodes) for each graph in the batch
-            num_nodes = non_zero_nodes_mask.sum(dim=1)  # Shape: (96,) - number of nodes for each graph in the batch
 
             # Update Discriminator
             # z = torch.randn(graph_layouts.shape[0], 128).to(device)  # Random noise for GAN on device
@@ -392,75 +671,67 @@ def train_combined_cgan(generator, discriminator, classifier, train_loader, val_
             # #generated_layouts = generator(z, graph_layouts, num_nodes=num_nodes)
             # generated_layouts = generator(z, graph_layouts,adj_matrices, num_nodes=num_nodes)
 
-            # # Train Discriminator
-            real_validity = discriminator(graph_layouts,adj_matrices)
-            # fake_validity = discriminator(generated_layouts.detach(),adj_matrices)
-            # Accumulate fake validity from multiple z samples
-            fake_validities = []
-            for _ in range(num_z_samples):
-                z = torch.randn(graph_layouts.shape[0], 128).to(device)
-                generated_layouts = generator(z, graph_layouts, adj_matrices, num_nodes=num_nodes)
-                # Detach so G won't be updated in this pass
-                fv = discriminator(generated_layouts.detach(), adj_matrices)
-                fake_validities.append(fv)
-            
-            # Average across z-samples
-            fake_validity = torch.stack(fake_validities, dim=0).mean(dim=0)
-             # WGAN Discriminator (Critic) loss
-            discriminator_loss = wasserstein_loss(real_validity, fake_validity)
+            # All z-samples are drawn as one super-batch of batch_size * num_z_samples graphs
+            # (row b * num_z_samples + k holds z-sample k of graph b)
+            batch_size = graph_layouts.size(0)
+            graph_layouts_rep = graph_layouts.repeat_interleave(num_z_samples, dim=0)
+            adj_matrices_rep = adj_matrices.repeat_interleave(num_z_samples, dim=0)
+            num_nodes_rep = num_nodes.repeat_interleave(num_z_samples)
+            labels_rep = labels.repeat_interleave(num_z_samples)
+
+            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=use_amp):
+                # # Train Discriminator
+                real_validity = discriminator(graph_layouts,adj_matrices)
+                # fake_validity = discriminator(generated_layouts.detach(),adj_matrices)
+                # One generator call for every z-sample (the layouts keep their graph for the generator update below)
+                z = z_buffer[:batch_size * num_z_samples].normal_()
+                gen_layouts = generator(z, graph_layouts_rep, adj_matrices_rep, num_nodes=num_nodes_rep)
+                # Detach so G won't be updated in this pass, then average across z-samples
+                fake_validity = discriminator(gen_layouts.detach(), adj_matrices_rep).view(batch_size, num_z_samples).mean(dim=1)
+                 # WGAN Discriminator (Critic) loss
+                discriminator_loss = wasserstein_loss(real_validity, fake_validity)
 
-            # Add gradient penalty
-            gp = compute_gradient_penalty(discriminator, graph_layouts, generated_layouts, adj_matrices, adj_matrices, device, lambda_gp)
+            # The penalty (and the saved images) use a single z-sample per graph
+            generated_layouts = gen_layouts.view(batch_size, num_z_samples, *gen_layouts.shape[1:])[:, -1]
+
+            # Add gradient penalty (on detached layouts, so the discriminator's backward never enters the generator's graph)
+            gp = compute_gradient_penalty(discriminator, graph_layouts, generated_layouts.detach(), adj_matrices, adj_matrices, device, lambda_gp)
             d_loss = discriminator_loss + gp
-            optimizer_d.zero_grad()
+            optimizer_d.zero_grad(set_to_none=True)
 
-             # Check Discriminator Gradients
-            d_loss.backward(retain_graph=True)  # Only retain the graph for the discriminator's backward pass
+             # Check Discriminator Gradients (only the discriminator's, so DDP reduces each model once per step)
+            # No retain_graph: the generator update below runs its own critic forward, so D's activations are freed here
+            scaler_d.scale(d_loss).backward(inputs=list(discriminator.parameters()))
             
             # Apply gradient clipping to discriminator
             # torch.nn.utils.clip_grad_norm_(discriminator.parameters(), max_norm=5.0)
-            optimizer_d.step()# Update discriminator
+            scaler_d.step(optimizer_d)# Update discriminator
+            scaler_d.update()
 
             total_d_loss += d_loss.item()
 
             # ---- Update Generator ---- Update Generator with multiple z-samples
-            # We'll accumulate the generator's adversarial loss & classifier loss
-            adv_losses = []
-            clf_losses = []
-
-            for _ in range(num_z_samples):
-                z = torch.randn(graph_layouts.shape[0], 128).to(device)
-                gen_layouts = generator(z, graph_layouts, adj_matrices, num_nodes=num_nodes)
-
-                # Adversarial loss for generator
-                f_validity = discriminator(gen_layouts, adj_matrices)
-                adv_loss = -torch.mean(f_validity)  # WGAN-G: maximize D output => negative sign
-
-                # Convert layouts to images for classification feedback
-                # (visualize_graph_layout is presumably your differentiable layout->image code)
-                images = []
-                for i, layout in enumerate(generated_layouts):
-                    adj_matrix = adj_matrices[i]  # Get corresponding adjacency matrix
-                    img = visualize_graph_layout(layout[:num_nodes[i]], adj_matrix=adj_matrix, size=(224, 224))  # Get image tensor directly
-                    images.append(img)
-                images = torch.stack(images).to(device)  # Concatenate into a batch tensor
-
-                
-
-                # Classifier loss
+            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=use_amp):
+                # Reuse the z-samples generated for the discriminator update, only the (updated) critic is re-run
+                # Adversarial loss for generator (the critic gets no gradient from it)
+                with _no_sync(discriminator):
+                    f_validity = discriminator(gen_layouts, adj_matrices_rep)
+                mean_adv_loss = -torch.mean(f_validity)  # WGAN-G: maximize D output => negative sign
+
+                # Convert layouts to images for classification feedback (whole super-batch in one pass). The layouts are
+                # detached by default, so as with the original renderer the classifier term gives the generator no
+                # gradient; differentiable_render=True lets alpha * classifier loss train the generator through it
+                render_layouts = gen_layouts if differentiable_render else gen_layouts.detach()
+                # (the edge list is extracted once from the B graphs and tiled over the z-samples)
+                edge_index = graph_edge_index(adj_matrices, num_nodes, repeats=num_z_samples)
+                images = renderer(render_layouts, adj_matrices_rep, num_nodes_rep, edge_index=edge_index)
+
+                # Classifier loss, averaged over all graphs and z-samples
                 outputs = classifier(images) # Classifier predictions
-                c_loss = criterion(outputs, labels) # Cross-entropy loss for classification
-
-                adv_losses.append(adv_loss)
-                clf_losses.append(c_loss)
-            
-
-            # Average across the z-samples
-            mean_adv_loss = torch.mean(torch.stack(adv_losses))
-            mean_clf_loss = torch.mean(torch.stack(clf_losses))
+                mean_clf_loss = criterion(outputs, labels_rep) # Cross-entropy loss for classification
 
-            # Weighted sum
-            g_loss = mean_adv_loss + alpha * mean_clf_loss
+                # Weighted sum
+                g_loss = mean_adv_loss + alpha * mean_clf_loss
 
 
             #fake_validity = discriminator(generated_layouts,adj_matrices)
@@ -492,51 +763,51 @@ def train_combined_cgan(generator, discriminator, classifier, train_loader, val_
             # g_loss = g_loss + alpha * c_loss  # alpha controls the influence of the classifier loss
 
             # Train Generator
-            optimizer_g.zero_grad()
+            optimizer_g.zero_grad(set_to_none=True)
             
             #g_loss = criterion(fake_validity, torch.ones_like(fake_validity).to(device))
-            g_loss.backward(retain_graph=True)
+            scaler_g.scale(g_loss).backward(retain_graph=True, inputs=list(generator.parameters()))
 
             # Apply gradient clipping to generator
             # torch.nn.utils.clip_grad_norm_(generator.parameters(), max_norm=5.0)
-            optimizer_g.step()
+            scaler_g.step(optimizer_g)
+            scaler_g.update()
             total_g_loss += g_loss.item()
 
             # ---- Update Classifier ----
             #outputs = classifier(images)
             c_loss = mean_clf_loss  # average of the loops
-            optimizer_c.zero_grad()
-            c_loss.backward()
-            optimizer_c.step()
+            optimizer_c.zero_grad(set_to_none=True)
+            # Only the classifier's gradients: with differentiable_render the renderer would otherwise carry this
+            # backward on into the generator, whose weights have already been updated in place
+            scaler_c.scale(c_loss).backward(inputs=list(classifier.parameters()))
+            scaler_c.step(optimizer_c)
+            scaler_c.update()
             total_c_loss += c_loss.item()
 
-            # Calculate training accuracy for this batch
-            _, predicted_train = torch.max(outputs, 1)
-            correct_train += (predicted_train == labels).sum().item()
+            # Calculate training accuracy for this batch (logits averaged over the z-samples)
+            _, predicted_train = torch.max(outputs.detach().view(batch_size, num_z_samples, -1).mean(dim=1), 1)
+            correct_train += (predicted_train == labels).sum()
             total_train += labels.size(0)  # Increment total number of samples
 
-            precision, recall, f1_score = calculate_f1(predicted_train, labels)
-            total_f1_train += f1_score
+            f1_counts_train += confusion_counts(predicted_train, labels)
 
 
             # Print batch processing time
-            print(f"Batch {batch_idx + 1}/{len(train_loader)} processed in {time.time() - batch_start:.2f} seconds")
+            print(f"Batch {batch_idx + 1}/{n_batches} processed in {time.time() - batch_start:.2f} seconds")
 
         
-            if batch_idx % 10 == 0:  # Visualize and save every 10 batches
-                for i, layout in enumerate(generated_layouts[:3]):  # Visualize the first 3 generated layouts
-                    # Generate the image using your visualize_graph_layout function
-                    img = plot_graph_layout(
-                        layout[:num_nodes[i]].detach().cpu().numpy(),
-                        adj_matrix=adj_matrices[i].detach().cpu().numpy(),
-                        return_tensor=False  # Set return_tensor to False to get the PIL image instead of a tensor
-                    )
-
+            if is_main and batch_idx % 10 == 0:  # Visualize and save every 10 batches
+                # One device-to-host copy for the first 3 generated layouts, the rendering and saving run on the I/O thread
+                layouts_cpu = generated_layouts[:3].detach().float().cpu().numpy()
+                adj_cpu = adj_matrices[:3].detach().cpu().numpy()
+                for i, n in enumerate(num_nodes[:3].tolist()):  # Visualize the first 3 generated layouts
                     # Construct the filename using the epoch, batch index, and image index
                     image_filename = f"epoch_{epoch}_batch_{batch_idx}_image_{i}.png"
                     
-                    # Save the image in the specified directory
-                    img.save(os.path.join(image_output_dir, image_filename))
+                    # Generate the image using plot_graph_layout and save it in the specified directory
+                    io_executor.submit(_save_layout_png, layouts_cpu[i, :n], adj_cpu[i],
+                                       os.path.join(image_output_dir, image_filename))
 
                     # Optionally, you can still display the image (remove this if not needed)
                     # plt.imshow(img)
@@ -545,19 +816,13 @@ def train_combined_cgan(generator, discriminator, classifier, train_loader, val_
             
 
         # Calculate training accuracy and F1 score for this epoch
-        train_accuracy = 100 * correct_train / total_train
-        avg_f1_train = total_f1_train / len(train_loader)
-
-        # Validation phase
-        val_accuracy, val_f1 = evaluate_model(generator, classifier, val_loader, device)
-
-        # Test phase (added after every epoch)
-        test_accuracy, test_f1 = evaluate_model(generator, classifier, test_loader, device)
+        train_accuracy = 100 * correct_train.item() / total_train
+        _, _, avg_f1_train = f1_from_counts(f1_counts_train)
 
         # Print epoch statistics
-        avg_g_loss = total_g_loss / len(train_loader)
-        avg_d_loss = total_d_loss / len(train_loader)
-        avg_c_loss = total_c_loss / len(train_loader)
+        avg_g_loss = total_g_loss / n_batches
+        avg_d_loss = total_d_loss / n_batches
+        avg_c_loss = total_c_loss / n_batches
 
         # Step the schedulers
         scheduler_g.step()
@@ -567,138 +832,133 @@ def train_combined_cgan(generator, discriminator, classifier, train_loader, val_
         print(f"Epoch {epoch+1}, Generator LR: {scheduler_g.get_last_lr()[0]}, Discriminator LR: {scheduler_d.get_last_lr()[0]}, Classifier LR: {scheduler_c.get_last_lr()[0]}")
         print(f"Generator Loss: {avg_g_loss:.4f}, Discriminator Loss: {avg_d_loss:.4f}, Classifier Loss: {avg_c_loss:.4f}")
         print(f"Training Accuracy: {train_accuracy:.2f}%, Training F1: {avg_f1_train:.4f}")
-        print(f"Validation Accuracy: {val_accuracy:.2f}%, Validation F1: {val_f1:.4f}")
-        print(f"Test Accuracy: {test_accuracy:.2f}%, Test F1: {test_f1:.4f}")
 
-        # Log metrics for this epoch
-        metrics["epoch"].append(epoch + 1)
-        metrics["generator_loss"].append(avg_g_loss)
-        metrics["discriminator_loss"].append(avg_d_loss)
-        metrics["classifier_loss"].append(avg_c_loss)
-        metrics["train_accuracy"].append(train_accuracy)
-        metrics["train_f1"].append(avg_f1_train)
-        metrics["val_accuracy"].append(val_accuracy)
-        metrics["val_f1"].append(val_f1)
-        metrics["test_accuracy"].append(test_accuracy)
-        metrics["test_f1"].append(test_f1)
+        # Resolve the previous epoch's evaluation, which ran alongside this epoch's training
+        if pending_eval is not None:
+            stop = finish_evaluation(pending_eval)
+            pending_eval = None
+            if stop:
+                break
+
+        # Snapshot this epoch's weights (the snapshots are free again, the previous evaluation has finished)
+        eval_generator.load_state_dict(_unwrap(generator).state_dict())
+        eval_classifier.load_state_dict(_unwrap(classifier).state_dict())
+        # The discriminator and optimizer states move on during the next epoch, before the evaluation has decided
+        # whether this epoch is saved, so they are copied now, to the host. This is a deliberate trade-off: every
+        # epoch pays the device-to-host copy (several hundred MB for a ViT classifier's Adam moments), not only
+        # the improving ones, in exchange for a checkpoint whose states all belong to the evaluated epoch
+        checkpoint = None
+        if is_main:
+            checkpoint = {
+                'generator_state_dict': eval_generator.state_dict(),
+                'discriminator_state_dict': _cpu_copy(_unwrap(discriminator).state_dict()),
+                'classifier_state_dict': eval_classifier.state_dict(),
+                'optimizer_g_state_dict': _cpu_copy(optimizer_g.state_dict()),
+                'optimizer_d_state_dict': _cpu_copy(optimizer_d.state_dict()),
+                'optimizer_c_state_dict': _cpu_copy(optimizer_c.state_dict()),
+                'epoch': epoch
+            }
+        if eval_stream is not None:
+            eval_stream.wait_stream(torch.cuda.current_stream(device))  # The snapshot copies must land first
+
+        # Validation phase and test phase (added after every epoch), in the background
+        future = eval_executor.submit(_evaluate_snapshot, eval_generator, eval_classifier,
+                                      [val_loader, test_loader], device, eval_stream)
+        pending_eval = (epoch, future, (avg_g_loss, avg_d_loss, avg_c_loss, train_accuracy, avg_f1_train), checkpoint)
+
+    # The last epoch's evaluation
+    if pending_eval is not None:
+        finish_evaluation(pending_eval)
+    eval_executor.shutdown(wait=True)
+
+    # Wait for the pending image dumps and CSV rows
+    io_executor.shutdown(wait=True)
+    if is_main:
+        log_file.close()
 
-        # Append metrics to CSV file
-        with open(log_path, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([epoch + 1, avg_g_loss, avg_d_loss, avg_c_loss, train_accuracy, avg_f1_train, val_accuracy, val_f1, test_accuracy, test_f1])
-
-        # Check for improvement in accuracy
-        if val_accuracy > best_accuracy :
-            best_accuracy = val_accuracy
-            epochs_without_improvement = 0  # Reset the counter if accuracy improves
+    # After training, save the metrics dictionary as a backup
+    if is_main:
+        torch.save(metrics, 'metrics.pth')
 
-            # Save the best model
-            torch.save({
-                'generator_state_dict': generator.state_dict(),
-                'discriminator_state_dict': discriminator.state_dict(),
-                'classifier_state_dict': classifier.state_dict(),
-                'optimizer_g_state_dict': optimizer_g.state_dict(),
-                'optimizer_d_state_dict': optimizer_d.state_dict(),
-                'optimizer_c_state_dict': optimizer_c.state_dict(),
-                'epoch': epoch,
-                'val_accuracy': val_accuracy,
-                'test_accuracy': test_accuracy
-            }, save_path)
-            print(f"Best model saved with validation accuracy: {val_accuracy:.2f}%")
-        else:
-            epochs_without_improvement += 1
-            print(f"Epochs without improvement: {epochs_without_improvement}")
 
-        # Early stopping condition
-        if epochs_without_improvement >= patience:
-            print(f"Early stopping triggered. No improvement for {patience} consecutive epochs.")
-            break
+def capture_classifier_forward(classifier, batch_shape, device, amp_dtype, use_amp, warmup_iters=3):
+    """
+    Captures the classifier's inference forward pass (under autocast) into a CUDA graph for a fixed batch shape.
 
-    # After training, save the metrics dictionary as a backup
-    torch.save(metrics, 'metrics.pth')
-
-
-# def evaluate_model(generator, classifier, test_loader, device):
-#     generator.eval()
-#     classifier.eval()
-#     correct = 0
-#     total = 0
-#     total_f1 = 0
-#     with torch.no_grad():
-#         for graph_layouts, adj_matrices, labels in test_loader:  # Unpack three values now
-#             graph_layouts = graph_layouts.float().to(device)
-#             adj_matrices = adj_matrices.float().to(device)
-#             labels = labels.to(device)
-
-#             z = torch.randn(graph_layouts.shape[0], 128).to(device)  # Random noise on device
-            
-#             non_zero_nodes_mask = torch.norm(graph_layouts, dim=2) > 0  # Shape: (96, 46)
+    Args:
+        classifier (nn.Module): The classifier, in eval mode.
+        batch_shape (tuple): Shape of the captured image batch (batch_size, 3, height, width).
+        device (str): The CUDA device.
+        amp_dtype (torch.dtype): Autocast dtype.
+        use_amp (bool): Whether autocast is enabled.
+        warmup_iters (int): Eager iterations run on a side stream before the capture.
 
-#             # Count the number of non-zero nodes (num_nodes) for each graph in the batch
-#             num_nodes = non_zero_nodes_mask.sum(dim=1)  # Shape: (96,) - number of nodes for each graph in the batch
-            
-#             # Generate layouts by passing the correct number of nodes and the input graph
-#             #generated_layouts = generator(z, graph_layouts, num_nodes=num_nodes)
-#             generated_layouts = generator(z, graph_layouts, adj_matrices, num_nodes=num_nodes)
-
-#             # Convert layouts to images for classification
-#             # images = []
-#             # for i, layout in enumerate(generated_layouts):
-#             #     adj_matrix = adj_matrices[i].detach().cpu().numpy()  # Get the corresponding adjacency matrix
-#             #     img = visualize_graph_layout(layout[:num_nodes[i]].detach().cpu().numpy(), adj_matrix=adj_matrix, return_tensor=True)
-#             #     images.append(img)
-#             # images = torch.stack(images).to(device)
-
-#             # Use the differentiable `visualize_graph_layout` for layout-to-image conversion
-#             images = []
-#             for i, layout in enumerate(generated_layouts):
-#                 adj_matrix = adj_matrices[i]  # Get corresponding adjacency matrix
-#                 img = visualize_graph_layout(layout[:num_nodes[i]], adj_matrix=adj_matrix, size=(224, 224))  # Get image tensor directly
-#                 images.append(img)
-#             images = torch.stack(images).to(device)  # Concatenate into a batch tensor
-
-#             # Classify using ResNet-50
-#             outputs = classifier(images)
-
-#             _, predicted = torch.max(outputs, 1)
-#             total += labels.size(0)
-#             correct += (predicted == labels).sum().item()
-
-#             # Calculate F1 score
-#             precision, recall, f1_score = calculate_f1(predicted, labels)
-#             total_f1 += f1_score
-
-#     accuracy = 100 * correct / total
-#     avg_f1 = total_f1 / len(test_loader)
-#     #print(f'Test Accuracy: {accuracy:.2f}%, F1 Score: {avg_f1:.4f}')
-#     return accuracy, avg_f1
-
-
-def evaluate_model(generator, classifier, test_loader, device, num_z_samples=5):
+    Returns:
+        forward (callable): forward(images) -> logits (FP32) for a batch of at most batch_shape[0] images.
+            The logits live in the graph's static output and are overwritten by the next call.
+    """
+    # Inference needs no DDP wrapper, whose forward may broadcast buffers (a collective cannot be captured)
+    classifier = _unwrap(classifier)
+    static_images = torch.zeros(batch_shape, device=device).contiguous(memory_format=torch.channels_last)
+
+    # Warm up on a side stream (autotuning, lazy initialisation) so none of it ends up in the graph. The warm-up
+    # uses the capture's autocast settings, so a compiled classifier's guards still hold during the capture
+    side_stream = torch.cuda.Stream(device=device)
+    side_stream.wait_stream(torch.cuda.current_stream(device))
+    with torch.cuda.stream(side_stream), torch.no_grad():
+        for _ in range(warmup_iters):
+            with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp, cache_enabled=False):
+                classifier(static_images)
+    torch.cuda.current_stream(device).wait_stream(side_stream)
+
+    # The autocast weight cache must be disabled during capture. The capture errors are thread-local since the
+    # evaluation may run next to the training thread
+    graph = torch.cuda.CUDAGraph()
+    with torch.no_grad(), torch.cuda.graph(graph, capture_error_mode='thread_local'):
+        with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp, cache_enabled=False):
+            static_outputs = classifier(static_images).float()
+
+    def forward(images):
+        # A smaller (last) batch fills the front of the static buffer, the stale rows behind it are ignored
+        num_images = images.size(0)
+        static_images[:num_images].copy_(images)
+        graph.replay()
+        return static_outputs[:num_images]
+
+    return forward
+
+def evaluate_model(generator, classifier, test_loader, device, num_z_samples=5, seed=0, use_amp=True, use_cuda_graph=False):
     generator.eval()
     classifier.eval()
-    correct = 0
+    # Optional CUDA graph for the classifier forward (the bulk of the evaluation step). The generator and renderer
+    # stay eager: the renderer's edge extraction has data-dependent shapes
+    use_cuda_graph = use_cuda_graph and torch.device(device).type == 'cuda'
+    classifier_graph = None
+    renderer = GraphLayoutRenderer(size=(224, 224))
+    # Reduced-precision classifier inference: BF16 where supported, FP16 otherwise (CUDA only)
+    use_amp = use_amp and torch.device(device).type == 'cuda'
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported() else torch.float16
+    # Dedicated, seeded RNG for the evaluation noise: every evaluation draws the same z-samples, and the
+    # background evaluation thread does not consume the training loop's global RNG stream
+    z_generator = torch.Generator(device=device)
+    z_generator.manual_seed(seed)
+    # The counts (correct predictions, and tp/fp/fn for the F1 score) are accumulated as int64 on the device,
+    # so no batch waits on a device-to-host transfer
+    correct = torch.zeros((), dtype=torch.long, device=device)
     total = 0
-    total_f1 = 0
-    with torch.no_grad():
-        for graph_layouts, adj_matrices, labels in test_loader:  # Unpack three values now
-            graph_layouts = graph_layouts.float().to(device)
-            adj_matrices = adj_matrices.float().to(device)
-            labels = labels.to(device)
-
+    f1_counts = torch.zeros(3, dtype=torch.long, device=device)
+    # inference_mode skips the version counters and view tracking that no_grad still maintains
+    with torch.inference_mode():
+        # Batches arrive on the device, the copy of the next one overlaps with this batch's compute
+        # (the loader also yields num_nodes, the number of non-zero nodes of each graph, precomputed by the dataset)
+        for graph_layouts, adj_matrices, labels, num_nodes in prefetch_to_device(test_loader, device):
             # z = torch.randn(graph_layouts.shape[0], 128).to(device)  # Random noise on device
             
-            non_zero_nodes_mask = torch.norm(graph_layouts, dim=2) > 0  # Shape: (96, 46)
-
-            # Count the number of non-zero nodes (num_nodes) for each graph in the batch
-            num_nodes = non_zero_nodes_mask.sum(dim=1)  # Shape: (96,) - number of nodes for each graph in the batch
-            
             batch_size = graph_layouts.size(0)
             # Generate layouts by passing the correct number of nodes and the input graph
             #generated_layouts = generator(z, graph_layouts, num_nodes=num_nodes)
             # generated_layouts = generator(z, graph_layouts, adj_matrices, num_nodes=num_nodes)
 
-            accum_logits = torch.zeros(batch_size, 2, device=device)
             # # Use the differentiable `visualize_graph_layout` for layout-to-image conversion
             # images = []
             # for i, layout in enumerate(generated_layouts):
@@ -710,37 +970,44 @@ def evaluate_model(generator, classifier, test_loader, device, num_z_samples=5):
             # # Classify using ResNet-50
             # outputs = classifier(images)
 
-            for _ in range(num_z_samples):
-                z = torch.randn(graph_layouts.shape[0], 128).to(device)
-                gen_layouts = generator(z, graph_layouts, adj_matrices, num_nodes = num_nodes)
-
-                # Convert layouts to images
-                images = []
-                for i, layout in enumerate(gen_layouts):
-                    adj_matrix = adj_matrices[i]  # Get corresponding adjacency matrix
-                    img = visualize_graph_layout(layout[:num_nodes[i]], adj_matrix=adj_matrix, size=(224, 224))  # Get image tensor directly
-                    images.append(img)
-                images = torch.stack(images).to(device)  # Concatenate into a batch tensor
-
-
-                # Classifier forward pass
-                outputs = classifier(images)  # shape: (batch_size, num_classes=2)
-
-                # We accumulate raw logits (before softmax)
-                accum_logits += outputs
-
-            # Average the logits over num_z_samples
-            accum_logits /= float(num_z_samples)
+            # All z-samples are drawn as one super-batch of batch_size * num_z_samples graphs
+            # (row b * num_z_samples + k holds z-sample k of graph b)
+            graph_layouts_rep = graph_layouts.repeat_interleave(num_z_samples, dim=0)
+            adj_matrices_rep = adj_matrices.repeat_interleave(num_z_samples, dim=0)
+            num_nodes_rep = num_nodes.repeat_interleave(num_z_samples)
+
+            # Sampled directly on the device instead of on the host and copied over
+            z = torch.randn(batch_size * num_z_samples, 128, device=device, generator=z_generator)
+            gen_layouts = generator(z, graph_layouts_rep, adj_matrices_rep, num_nodes = num_nodes_rep)
+
+            # Convert layouts to images, the whole super-batch is rendered in one pass
+            # (the edge list is extracted once from the B graphs and tiled over the z-samples)
+            edge_index = graph_edge_index(adj_matrices, num_nodes, repeats=num_z_samples)
+            images = renderer(gen_layouts, adj_matrices_rep, num_nodes_rep, edge_index=edge_index)
+
+            # Classifier forward pass, on channels-last images under autocast
+            images = images.contiguous(memory_format=torch.channels_last)
+            if use_cuda_graph:
+                if classifier_graph is None:
+                    # Captured for the loader's full batch size, the last partial batch is padded
+                    classifier_graph = capture_classifier_forward(classifier, (test_loader.batch_size * num_z_samples, *images.shape[1:]),
+                                                                  device, amp_dtype, use_amp)
+                outputs = classifier_graph(images)  # consumed below, before the next replay
+            else:
+                with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp):
+                    outputs = classifier(images)  # shape: (batch_size * num_z_samples, num_classes=2)
+
+            # Average the raw logits (before softmax) over num_z_samples, in FP32
+            accum_logits = outputs.float().view(batch_size, num_z_samples, -1).mean(dim=1)
 
             _, predicted = torch.max(accum_logits, 1)
             total += labels.size(0)
-            correct += (predicted == labels).sum().item()
+            correct += (predicted == labels).sum()
 
-            # Calculate F1 score
-            precision, recall, f1_score = calculate_f1(predicted, labels)
-            total_f1 += f1_score
+            f1_counts += confusion_counts(predicted, labels)
 
-    accuracy = 100 * correct / total
-    avg_f1 = total_f1 / len(test_loader)
+    accuracy = 100 * correct.item() / total
+    # Calculate F1 score over the whole set
+    precision, recall, avg_f1 = f1_from_counts(f1_counts)
     #print(f'Test Accuracy: {accuracy:.2f}%, F1 Score: {avg_f1:.4f}')
     return accuracy, avg_f1
\ No newline at end of file
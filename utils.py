@@ -1,5 +1,9 @@
+import math
 import torch
-import matplotlib.pyplot as plt
+import torch.distributed as dist
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
 import numpy as np
 from PIL import Image
 import torchvision.transforms as transforms
@@ -8,7 +12,11 @@ from torchvision.transforms import GaussianBlur
 from torchvision.transforms.functional import to_pil_image
 
 def plot_graph_layout(layout, adj_matrix=None, size=(224, 224), return_tensor=True):
-    fig, ax = plt.subplots(figsize=(3, 3))  # 224x224 pixels corresponds to 3 inches at 72 DPI
+    # A standalone Agg figure instead of pyplot, whose global state is not safe off the main thread (the image
+    # dumps run on the I/O thread)
+    fig = Figure(figsize=(3, 3))  # 224x224 pixels corresponds to 3 inches at 72 DPI
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
 
        # Ensure layout is a tensor (if it's still a numpy array, convert to tensor first)
     if isinstance(layout, np.ndarray):
@@ -32,14 +40,10 @@ def plot_graph_layout(layout, adj_matrix=None, size=(224, 224), return_tensor=Tr
         # Ensure the adjacency matrix matches the number of nodes in the layout
         adj_matrix = adj_matrix[:layout.shape[0], :layout.shape[0]]  # Crop to match the number of nodes
 
-        # Draw edges
-        num_nodes = layout.shape[0]
-        for i in range(num_nodes):
-            for j in range(i + 1, num_nodes):
-                if adj_matrix[i, j] == 1:  # If there's an edge between node i and node j
-                    ax.plot([layout[i, 0], layout[j, 0]],  # Draw edge from node i to node j
-                            [layout[i, 1], layout[j, 1]], 
-                            color="blue", lw=1.0, alpha=0.7)  # Blue edges with thicker lines
+        # Draw edges: all edges (i < j) as a single LineCollection instead of one Line2D artist per edge
+        src, dst = np.nonzero(np.triu(np.asarray(adj_matrix) == 1, k=1))
+        segments = np.stack([layout[src], layout[dst]], axis=1)  # Shape: (num_edges, 2, 2)
+        ax.add_collection(LineCollection(segments, colors="blue", linewidths=1.0, alpha=0.7))  # Blue edges with thicker lines
 
     # Draw nodes with red markers (s=50 for marker size)
     ax.scatter(layout[:, 0], layout[:, 1], color='red', s=10, edgecolor='black', zorder=5)
@@ -47,13 +51,12 @@ def plot_graph_layout(layout, adj_matrix=None, size=(224, 224), return_tensor=Tr
     # Set limits and hide axis
     ax.set_xlim(0, size[0])
     ax.set_ylim(0, size[1])
-    plt.axis('off')
+    ax.axis('off')
     fig.canvas.draw()
 
     # Convert plot to RGB image
     image = np.frombuffer(fig.canvas.tostring_rgb(), dtype=np.uint8)
     image = image.reshape(fig.canvas.get_width_height()[::-1] + (3,))
-    plt.close(fig)
 
     # Resize to 224x224 pixels
     pil_img = Image.fromarray(image)
@@ -129,6 +132,181 @@ def visualize_graph_layout(layout, adj_matrix, size=(224, 224), line_thickness=1
     return image  # Return as differentiable tensor if needed
 
 
+# ImageNet normalization constants, kept as Python floats so no host-to-device copy is needed per call
+_IMAGENET_MEAN = (0.485, 0.456, 0.406)
+_IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def _splat(points, weights, batch_index, batch_size, height, width):
+    """
+    Bilinearly splats weighted points onto a batch of single-channel canvases.
+
+    Args:
+    - points (torch.Tensor): Pixel coordinates (x, y), shape (..., 2).
+    - weights (torch.Tensor): Weight of each point, shape (...).
+    - batch_index (torch.Tensor): Canvas index of each point, shape (...).
+
+    Returns:
+    - canvas (torch.Tensor): Accumulated weights, shape (batch_size, height, width).
+    """
+    x, y = points[..., 0], points[..., 1]
+    x0, y0 = x.detach().floor(), y.detach().floor()
+    fx, fy = x - x0, y - y0  # Fractional offsets carry the gradient w.r.t. the coordinates
+
+    canvas = points.new_zeros(batch_size * height * width)
+    corners = ((0, 0, (1 - fx) * (1 - fy)), (1, 0, fx * (1 - fy)), (0, 1, (1 - fx) * fy), (1, 1, fx * fy))
+    for dx, dy, corner_weight in corners:
+        x_idx = (x0 + dx).long()
+        y_idx = (y0 + dy).long()
+        valid = (0 <= x_idx) & (x_idx < width) & (0 <= y_idx) & (y_idx < height)
+        index = (batch_index * height + y_idx.clamp(0, height - 1)) * width + x_idx.clamp(0, width - 1)
+        canvas = canvas.index_add(0, index.flatten(), (weights * corner_weight * valid).flatten())
+    return canvas.view(batch_size, height, width)
+
+
+def graph_edge_index(adj_matrices, num_nodes, repeats=1):
+    """
+    Edge list of a batch of padded graphs (each undirected edge once, actual nodes only), as used by
+    GraphLayoutRenderer. The topology does not depend on the layout, so it can be computed once and
+    reused for every layout drawn for the same graphs.
+
+    Args:
+    - adj_matrices (torch.Tensor): Padded adjacency matrices, shape (batch_size, max_nodes, max_nodes).
+    - num_nodes (torch.Tensor): Number of actual nodes in each graph, shape (batch_size,).
+    - repeats (int): Tile the edge list for a batch in which every graph is repeated this many times
+      consecutively (as with repeat_interleave), e.g. once per z-sample.
+
+    Returns:
+    - edge_index (tuple of torch.Tensor): Graph index, source node and destination node of every edge.
+    """
+    max_nodes = adj_matrices.size(1)
+    node_ids = torch.arange(max_nodes, device=adj_matrices.device)
+    node_mask = node_ids[None, :] < num_nodes.to(adj_matrices.device)[:, None]
+
+    edge_mask = (adj_matrices > 0) | (adj_matrices.transpose(1, 2) > 0)
+    edge_mask = edge_mask & node_mask[:, :, None] & node_mask[:, None, :] & (node_ids[:, None] < node_ids[None, :])
+    edge_batch, edge_src, edge_dst = edge_mask.nonzero(as_tuple=True)
+
+    if repeats > 1:
+        # Graph b becomes graphs b * repeats ... b * repeats + repeats - 1, all with the same edges
+        copies = torch.arange(repeats, device=adj_matrices.device)
+        edge_batch = (edge_batch[:, None] * repeats + copies[None, :]).flatten()
+        edge_src = edge_src.repeat_interleave(repeats)
+        edge_dst = edge_dst.repeat_interleave(repeats)
+    return edge_batch, edge_src, edge_dst
+
+
+class GraphLayoutRenderer:
+    """
+    Batched, differentiable counterpart of visualize_graph_layout: renders a whole batch of padded layouts
+    in one pass, without a Python loop over the graphs.
+
+    The renderer is specialised to one image size and style: the edge sampling steps, the node, edge and blur
+    kernels are built once per device on first use and reused by every call.
+
+    Args:
+    - size (tuple): Image size (width, height).
+    - line_thickness (int): Nodes are squares of side 2 * line_thickness + 1.
+    - edge_alpha (float): Opacity of the edges.
+    - edge_thickness (int): Radius of the circular dilation of the edges (0 for one-pixel lines).
+    """
+    def __init__(self, size=(224, 224), line_thickness=1, edge_alpha=1, edge_thickness=0):
+        self.width, self.height = size
+        self.line_thickness = line_thickness
+        self.edge_alpha = edge_alpha
+        self.edge_thickness = edge_thickness
+        # Sample every edge at (at most) one pixel spacing
+        self.num_steps = int(math.hypot(self.width, self.height)) + 1
+        self._constants = {}  # Per-device cache of the tensors above
+
+    def _device_constants(self, device):
+        if device not in self._constants:
+            t_values = torch.linspace(0, 1, steps=self.num_steps, device=device)
+
+            # Circular mask for the edge dilation, square mask for the nodes
+            offsets = torch.arange(-self.edge_thickness, self.edge_thickness + 1, device=device)
+            disk = ((offsets[:, None] ** 2 + offsets[None, :] ** 2) <= self.edge_thickness ** 2).float()[None, None]
+            kernel_size = 2 * self.line_thickness + 1
+            node_kernel = torch.ones(1, 1, kernel_size, kernel_size, device=device)
+
+            # 5x5 Gaussian blur with sigma 1 (as torchvision's GaussianBlur), one depthwise kernel per channel
+            x = torch.linspace(-2, 2, steps=5, device=device)
+            blur_1d = torch.exp(-0.5 * x ** 2)
+            blur_1d = blur_1d / blur_1d.sum()
+            blur_kernel = (blur_1d[:, None] * blur_1d[None, :]).expand(3, 1, 5, 5).contiguous()
+
+            self._constants[device] = (t_values, disk, node_kernel, blur_kernel)
+        return self._constants[device]
+
+    def __call__(self, layouts, adj_matrices, num_nodes, edge_index=None):
+        """
+        Args:
+        - layouts (torch.Tensor): Padded node coordinates, shape (batch_size, max_nodes, 2).
+        - adj_matrices (torch.Tensor): Padded adjacency matrices, shape (batch_size, max_nodes, max_nodes).
+          Only used when edge_index is not given.
+        - num_nodes (torch.Tensor): Number of actual nodes in each graph, shape (batch_size,).
+        - edge_index (tuple of torch.Tensor, optional): Precomputed edge list from graph_edge_index.
+
+        Returns:
+        - images (torch.Tensor): Normalized images, shape (batch_size, 3, height, width).
+        """
+        batch_size, max_nodes, _ = layouts.shape
+        width, height = self.width, self.height
+        device = layouts.device
+        layouts = layouts.float()
+        t_values, disk, node_kernel, blur_kernel = self._device_constants(device)
+
+        # Padded nodes are masked out instead of sliced away, so every graph keeps the same shape
+        node_ids = torch.arange(max_nodes, device=device)
+        node_mask = node_ids[None, :] < num_nodes.to(device)[:, None]  # Shape: (batch_size, max_nodes)
+
+        # Normalize and scale each layout to fit with padding (min/max over the actual nodes only)
+        mask = node_mask.unsqueeze(-1)
+        layout_min = torch.where(mask, layouts, torch.full_like(layouts, float('inf'))).amin(dim=1, keepdim=True)
+        layout_max = torch.where(mask, layouts, torch.full_like(layouts, float('-inf'))).amax(dim=1, keepdim=True)
+        layouts = (layouts - layout_min) / (layout_max - layout_min + 1e-8)  # Normalize to [0, 1]
+        # Scale to size with padding (per axis with Python scalars, no constant tensor to copy to the device)
+        layouts = torch.stack([layouts[..., 0] * (width - 20), layouts[..., 1] * (height - 20)], dim=-1) + 10
+
+        # Edge list of the whole batch (each undirected edge once, actual nodes only)
+        if edge_index is None:
+            edge_index = graph_edge_index(adj_matrices, num_nodes)
+        edge_batch, edge_src, edge_dst = edge_index
+
+        # Sample every edge at (at most) one pixel spacing; each sample carries an equal share of the edge length
+        num_steps = self.num_steps
+        start_points = layouts[edge_batch, edge_src]
+        end_points = layouts[edge_batch, edge_dst]
+        points = start_points[:, None, :] + t_values[None, :, None] * (end_points - start_points)[:, None, :]
+        weights = ((end_points - start_points).norm(dim=1, keepdim=True) / num_steps).expand(-1, num_steps)
+        edge_canvas = _splat(points, weights, edge_batch[:, None].expand(-1, num_steps), batch_size, height, width)
+
+        # Thicker edges are drawn by dilating the line with a circular mask
+        if self.edge_thickness > 0:
+            edge_canvas = F.conv2d(edge_canvas.unsqueeze(1), disk, padding=self.edge_thickness).squeeze(1)
+        edge_coverage = edge_canvas.clamp(max=1)
+
+        # Nodes are small squares of side 2 * line_thickness + 1
+        node_batch = torch.arange(batch_size, device=device)[:, None].expand(-1, max_nodes)
+        node_canvas = _splat(layouts, node_mask.float(), node_batch, batch_size, height, width)
+        node_coverage = F.conv2d(node_canvas.unsqueeze(1), node_kernel, padding=self.line_thickness).squeeze(1).clamp(max=1)
+
+        # Composite on a white background: blue edges (dimming red/green by edge_alpha), then red nodes on top
+        red_green = 1 - edge_coverage * self.edge_alpha
+        blue = 1 - edge_coverage + edge_coverage * self.edge_alpha
+        channels = (red_green * (1 - node_coverage) + node_coverage,
+                    red_green * (1 - node_coverage),
+                    blue * (1 - node_coverage))
+
+        # Normalize image for consistent appearance. The per-channel normalization is applied before the blur:
+        # the blur is a normalized kernel with reflect padding, so both orders give the same image, and this way
+        # the constants stay Python scalars fused into the channel composition
+        image = torch.stack([(channel - mean) / std for channel, mean, std in zip(channels, _IMAGENET_MEAN, _IMAGENET_STD)], dim=1)
+
+        # Apply Gaussian blur for smoother appearance (cached kernel, reflect padding as in torchvision)
+        image = F.conv2d(F.pad(image, (2, 2, 2, 2), mode='reflect'), blur_kernel, groups=3)
+
+        return image
 
 
 # def save_tensor_as_pdf(layout, adj_matrix, save_path, size=(224, 224)):
@@ -200,4 +378,12 @@ def remove_module_prefix(state_dict):
     for key, value in state_dict.items():
         new_key = key.replace('module.', '')  # Remove 'module.' from keys
         new_state_dict[new_key] = value
-    return new_state_dict
\ No newline at end of file
+    return new_state_dict
+
+
+def is_main_process():
+    """
+    Returns True on rank 0 of a distributed run (or always, when torch.distributed is not initialized).
+    Used to keep file writes (logs, checkpoints, images) to a single process.
+    """
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0